@@ -2,80 +2,444 @@ import subprocess
 import os
 import shutil
 import logging
-from cryptography.fernet import Fernet
+import base64
+import json
+import struct
+import zipfile
+import shlex
+import re
+import tempfile
+import tarfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from datetime import datetime
+from shell import AdbShell
+
+try:
+    # Optional, much faster JSON for large SMS/call log backups
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Optional, only needed for zstd-compressed backups
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Streamed backup format: version || flags, then one frame per chunk of
+# plaintext: nonce || AES-256-GCM ciphertext || tag. Every frame but the last
+# holds exactly CHUNK_SIZE bytes of plaintext; the frame index and a last-frame
+# marker are bound in as associated data so frames can't be reordered or cut.
+STREAM_VERSION = b"\x82"
+STREAM_HEADER_SIZE = 2
+NONCE_SIZE = 12
+TAG_SIZE = 16
+CHUNK_SIZE = 1024 * 1024
+FRAME_SIZE = NONCE_SIZE + CHUNK_SIZE + TAG_SIZE
+FLAG_ZSTD = 0x01
+ZSTD_LEVEL = 3
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Older backups are one Fernet token: base64(0x80 || timestamp || iv ||
+# AES-128-CBC ciphertext || HMAC-SHA256)
+FERNET_VERSION = b"\x80"
+FERNET_HEADER_SIZE = 1 + 8 + 16
+FERNET_HMAC_SIZE = 32
+
+# `content query` prints one "Row: N key=value, key=value" line per record, in
+# projection order. Free-text columns go last so embedded ", " can't shift
+# the fields after them.
+CONTACT_RE = re.compile(r"^Row: \d+ display_name=(?P<name>.*?), data1=(?P<phone>.*?)[ \t\r]*$", re.M)
+SMS_RE = re.compile(
+    r"^Row: \d+ address=(?P<address>[^,\n]*), date=(?P<date>[^,\n]*), "
+    r"type=(?P<type>[^,\n]*), body=(?P<body>.*?)[ \t\r]*$", re.M
+)
+CALL_RE = re.compile(
+    r"^Row: \d+ number=(?P<number>[^,\n]*), date=(?P<date>[^,\n]*), "
+    r"duration=(?P<duration>[^,\n]*), type=(?P<type>[^,\n]*), name=(?P<name>.*?)[ \t\r]*$", re.M
+)
+
+RESTORE_PUSH_WORKERS = 4
+SMS_RESTORE_WORKERS = 8
+SMS_SCRIPT_BATCH = 500
+SMS_SCRIPT_DIR = "/data/local/tmp"
+# Prepended to every pushed batch; defines $NL for _quote_line
+SMS_SCRIPT_HEADER = "set -e\nNL=$(printf '\\n_'); NL=${NL%_}\n"
+# Saved next to an SMS backup by backup_sms: this first line, then one insert
+# per line. Restore only runs it when every line matches SMS_SCRIPT_LINE_RE.
+SMS_SCRIPT_SUFFIX = ".restore.sh"
+SMS_SCRIPT_MAGIC = "# Android Backup Buddy SMS restore script v1\n"
+# One shlex.quote()d word, or several joined by "$NL" (see _quote_line)
+_QUOTED_WORD = r"""(?:[A-Za-z0-9_@%+=:,./-]+|'[^']*'(?:"'"'[^']*')*)"""
+_QUOTED_ARG = rf'{_QUOTED_WORD}(?:"\$NL"{_QUOTED_WORD})*'
+SMS_SCRIPT_LINE_RE = re.compile(rf"content insert --uri content://sms(?: --bind {_QUOTED_ARG}){{4}}\n")
+# The backup is written just after its script; allow for that before
+# calling the script stale
+SMS_SCRIPT_MTIME_SLACK = 2.0
+
+
+class BackupCancelled(Exception):
+    """Raised inside a BackupManager operation once its `cancelled` event is set."""
+
+
+def _check_cancelled(cancelled):
+    """Raises BackupCancelled if the (optional) `cancelled` event is set."""
+    if cancelled is not None and cancelled.is_set():
+        raise BackupCancelled("Cancelled by user")
+
+
+def _json_line(record):
+    """Serializes one record as a compact NDJSON line."""
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _quote_line(value):
+    """
+    shlex.quote, but newlines are spliced in as "$NL" (see SMS_SCRIPT_HEADER)
+    so every insert command stays on one physical line of the script.
+    """
+    return '"$NL"'.join(shlex.quote(part) for part in value.split("\n"))
+
+
+def _sms_script_path(backup_path):
+    """Path of the prebuilt restore script saved next to an SMS backup."""
+    return os.path.splitext(backup_path)[0] + SMS_SCRIPT_SUFFIX
+
+
+def _frame_aad(header, index, last):
+    return header + struct.pack(">Q?", index, last)
+
+
+class _EncryptedWriter:
+    """
+    Write-only file object that encrypts everything written to it.
+    With compression="zstd" the stream is zstd-compressed before encryption.
+    """
+
+    def __init__(self, path, aesgcm, compression=None):
+        flags = 0
+        self._compressor = None
+        if compression == "zstd":
+            flags |= FLAG_ZSTD
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif compression is not None:
+            raise ValueError(f"Unsupported compression: {compression}")
+
+        self._aesgcm = aesgcm
+        self._header = STREAM_VERSION + bytes([flags])
+        self._index = 0
+        self._buffer = bytearray()
+        self._file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self._file.write(self._header)
+
+    def _seal(self, chunk, last):
+        nonce = os.urandom(NONCE_SIZE)
+        aad = _frame_aad(self._header, self._index, last)
+        self._file.write(nonce)
+        self._file.write(self._aesgcm.encrypt(nonce, chunk, aad))
+        self._index += 1
+
+    def write(self, data):
+        size = len(data)
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        while len(self._buffer) >= CHUNK_SIZE:
+            self._seal(bytes(self._buffer[:CHUNK_SIZE]), last=False)
+            del self._buffer[:CHUNK_SIZE]
+        return size
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._compressor:
+            self._buffer += self._compressor.flush()
+        # The final frame is always short (possibly empty), which is how the
+        # reader tells it apart from a file truncated on a frame boundary.
+        self._seal(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _decrypt_stream(aesgcm, src, dst, cancelled=None):
+    """Decrypts a streamed backup from `src` into `dst`, frame by frame."""
+    header = src.read(STREAM_HEADER_SIZE)
+    if len(header) < STREAM_HEADER_SIZE or header[:1] != STREAM_VERSION:
+        raise ValueError("Not a streamed backup file")
+
+    flags = header[1]
+    if flags & ~FLAG_ZSTD:
+        raise ValueError(f"Unsupported backup flags: {flags:#x}")
+    decompressor = None
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Backup is zstd-compressed; install 'zstandard' to decrypt it")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    index = 0
+    while True:
+        _check_cancelled(cancelled)
+        frame = src.read(FRAME_SIZE)
+        if len(frame) < NONCE_SIZE + TAG_SIZE:
+            raise ValueError("Backup file is truncated")
+        last = len(frame) < FRAME_SIZE
+        aad = _frame_aad(header, index, last)
+        try:
+            chunk = aesgcm.decrypt(frame[:NONCE_SIZE], frame[NONCE_SIZE:], aad)
+        except InvalidTag:
+            raise ValueError("Backup is corrupted or was made with a different key")
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        dst.write(chunk)
+        if last:
+            return
+        index += 1
+
+
+class _StrictTarInfo(tarfile.TarInfo):
+    """
+    TarInfo for streamed reads that fails on a missing or garbled header.
+    Plain tarfile takes either for the end of the archive, so a stream cut
+    short or with error text mixed in would pass as a complete backup; only
+    tar's zero end-of-archive block ends the stream here.
+    """
+
+    @classmethod
+    def fromtarfile(cls, tarfile_obj):
+        try:
+            return super().fromtarfile(tarfile_obj)
+        except (tarfile.EmptyHeaderError, tarfile.TruncatedHeaderError, tarfile.InvalidHeaderError) as e:
+            raise tarfile.ReadError(f"tar stream is incomplete or corrupted: {e}") from None
+
+
+def _copy_tar_to_zip(tar, archive, cancelled=None):
+    """Copies directories and regular files from a streamed tar into a zip."""
+    for member in tar:
+        _check_cancelled(cancelled)
+        name = member.name
+        if name.startswith("./"):
+            name = name[2:]
+        if not name or name == ".":
+            continue
+
+        date_time = time.localtime(member.mtime)[:6]
+        if date_time[0] < 1980:
+            # Earliest date a zip header can hold
+            date_time = (1980, 1, 1, 0, 0, 0)
+
+        if member.isdir():
+            info = zipfile.ZipInfo(name.rstrip("/") + "/", date_time)
+            info.external_attr = ((0o40000 | member.mode) << 16) | 0x10
+            archive.writestr(info, b"")
+        elif member.isfile():
+            info = zipfile.ZipInfo(name, date_time)
+            info.external_attr = (0o100000 | member.mode) << 16
+            info.file_size = member.size
+            with archive.open(info, "w", force_zip64=member.size > zipfile.ZIP64_LIMIT) as dst:
+                src = tar.extractfile(member)
+                while chunk := src.read(CHUNK_SIZE):
+                    _check_cancelled(cancelled)
+                    dst.write(chunk)
+
+
+def _decrypt_fernet_stream(key, src, dst, cancelled=None):
+    """
+    Decrypts a legacy Fernet backup from `src` into `dst` a chunk at a time
+    rather than loading the whole token like Fernet.decrypt does.
+    The HMAC is checked at the end; callers must discard `dst` on failure.
+    """
+    key = base64.urlsafe_b64decode(key)
+    h = hmac.HMAC(key[:16], hashes.SHA256())
+    decryptor = None
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+
+    # CHUNK_SIZE is a multiple of 4, so each read decodes on its own.
+    # The last HMAC-sized bytes are held back until we hit the end.
+    pending = b""
+    while True:
+        _check_cancelled(cancelled)
+        text = src.read(CHUNK_SIZE)
+        if not text:
+            break
+        pending += base64.urlsafe_b64decode(text)
+
+        if decryptor is None:
+            if len(pending) < FERNET_HEADER_SIZE:
+                continue
+            header, pending = pending[:FERNET_HEADER_SIZE], pending[FERNET_HEADER_SIZE:]
+            if header[:1] != FERNET_VERSION:
+                raise ValueError("Not an encrypted backup file")
+            h.update(header)
+            iv = header[9:]
+            decryptor = Cipher(algorithms.AES(key[16:]), modes.CBC(iv)).decryptor()
+
+        body, pending = pending[:-FERNET_HMAC_SIZE], pending[-FERNET_HMAC_SIZE:]
+        h.update(body)
+        dst.write(unpadder.update(decryptor.update(body)))
+
+    if decryptor is None:
+        raise ValueError("Backup file is truncated")
+    try:
+        h.verify(pending)
+    except InvalidSignature:
+        raise ValueError("Backup is corrupted or was made with a different key")
+    dst.write(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+
+
+def _backup_device_worker(device_id, source_path, dest_folder, compression):
+    """Process pool entry point for BackupManager.backup_devices_parallel."""
+    return BackupManager(device_id).backup_device(source_path, dest_folder, compression)
+
 
 class BackupManager:
     def __init__(self, device_id):
         self.device_id = device_id
-        
-    def _generate_key(self, key_path="backup_key.key"):
-        """Generates a key and saves it into a file."""
-        key = Fernet.generate_key()
-        with open(key_path, "wb") as key_file:
-            key_file.write(key)
-        return key
-
-    def _load_key(self, key_path="backup_key.key"):
-        """Loads the key from the current directory named `backup_key.key`."""
-        if not os.path.exists(key_path):
-             return self._generate_key(key_path)
-        with open(key_path, "wb") as key_file: # Oops, reading mode is 'rb'
-             pass 
-        # Actually let's just use 'rb' correctly
-        return open(key_path, "rb").read()
+        self._key = None
+        self._cipher = None
+        self._shell_v2 = None
+        self._shell = AdbShell(device_id)
+        # Set from another thread to stop a running operation at its next
+        # checkpoint; it then fails and cleans up like on any other error.
+        # The caller clears it before starting the next one.
+        self.cancelled = threading.Event()
+
+    def close(self):
+        """Ends this device's adb shell session, if one was started."""
+        self._shell.close()
 
     def _get_key(self):
-        """Helper to get or create key."""
+        """Helper to get or create key. Read once, then cached on the instance."""
+        if self._key is not None:
+            return self._key
         if os.path.exists("backup_key.key"):
             with open("backup_key.key", "rb") as f:
-                return f.read()
+                self._key = f.read()
         else:
-            key = Fernet.generate_key()
+            # Same encoding as a Fernet key, so old backups stay readable
+            key = base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=256))
             with open("backup_key.key", "wb") as f:
                 f.write(key)
             logging.info("Generated new encryption key: backup_key.key")
-            return key
+            self._key = key
+        return self._key
+
+    def _get_cipher(self):
+        """AES-GCM cipher for this instance's key, built once and reused."""
+        if self._cipher is None:
+            self._cipher = AESGCM(base64.urlsafe_b64decode(self._get_key()))
+        return self._cipher
 
-    def backup_device(self, source_path, dest_folder="backups"):
+    def _has_shell_v2(self):
+        """
+        Whether the device speaks adb's shell protocol v2 (Android 7+), which
+        keeps stderr separate and reports the exit code. Asked once, then cached.
+        """
+        if self._shell_v2 is None:
+            try:
+                result = subprocess.run(["adb", "-s", self.device_id, "features"],
+                                        capture_output=True, text=True, check=True)
+                self._shell_v2 = "shell_v2" in re.split(r"[\s,]+", result.stdout)
+                if not self._shell_v2:
+                    logging.warning(
+                        f"Device {self.device_id} lacks adb shell protocol v2 (Android 6 or older); "
+                        "tar errors will show up as a corrupted stream. Folder backups need Android 5.0+."
+                    )
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.warning(f"Could not read adb features of {self.device_id}: {e}")
+                self._shell_v2 = False
+        return self._shell_v2
+
+    def backup_device(self, source_path, dest_folder="backups", compression=None):
         """
         Pulls data from device, zips it, encrypts it.
         source_path: path on device (e.g. /sdcard/DCIM)
         dest_folder: local folder to save backup
+        compression: None to store files as-is (photos/videos are already
+            compressed), or "zstd" to compress the whole archive
         """
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        if compression == "zstd" and zstandard is None:
+            logging.error("zstd compression requires the 'zstandard' package.")
+            return None
+
+        os.makedirs(dest_folder, exist_ok=True)
             
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        temp_dir = f"temp_backup_{self.device_id}_{timestamp}"
+        encrypted_filename = f"backup_{self.device_id}_{timestamp}.enc"
+        encrypted_path = os.path.join(dest_folder, encrypted_filename)
         
         try:
-            # 1. Pull data
+            # 1. Stream the source as a tar from the device; nothing touches local disk.
+            # The path is quoted for the device shell.
             logging.info(f"Pulling {source_path} from device {self.device_id}...")
-            # ADB pull destination is a local path
-            cmd = ["adb", "-s", self.device_id, "pull", source_path, temp_dir]
-            subprocess.run(cmd, check=True, capture_output=True)
-            
-            # 2. Archive (Zip)
-            logging.info("Archiving data...")
-            shutil.make_archive(temp_dir, 'zip', temp_dir)
-            zip_file = f"{temp_dir}.zip"
-            
-            # 3. Encrypt
-            logging.info("Encrypting backup...")
-            key = self._get_key()
-            f = Fernet(key)
-            
-            with open(zip_file, "rb") as file:
-                file_data = file.read()
-                
-            encrypted_data = f.encrypt(file_data)
-            
-            encrypted_filename = f"backup_{self.device_id}_{timestamp}.enc"
-            encrypted_path = os.path.join(dest_folder, encrypted_filename)
-            
-            with open(encrypted_path, "wb") as file:
-                file.write(encrypted_data)
+            tar_cmd = shlex.join(["tar", "-cf", "-", "-C", source_path, "."])
+            if self._has_shell_v2():
+                # `shell -T` (no pty) keeps tar's stderr off the data stream
+                # and returns its exit code
+                cmd = ["adb", "-s", self.device_id, "shell", "-T", tar_cmd]
+            else:
+                # Android 6 and older: exec-out (Android 5.0+) mixes stderr into
+                # the stream and always exits 0, so a failed read is only caught
+                # by _StrictTarInfo rejecting the damaged stream
+                cmd = ["adb", "-s", self.device_id, "exec-out", tar_cmd]
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
+                # Read on the side so a flood of tar errors can't fill the
+                # stderr pipe and stall the data stream
+                errors = []
+                drain = threading.Thread(target=lambda: errors.append(p.stderr.read()), daemon=True)
+                drain.start()
+
+                # 2. Archive (Zip) straight into the encryptor as the tar arrives.
+                # The key is loaded while adb is still connecting.
+                logging.info("Archiving and encrypting data...")
+                try:
+                    with _EncryptedWriter(encrypted_path, self._get_cipher(), compression) as stream:
+                        with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED) as archive:
+                            with tarfile.open(fileobj=p.stdout, mode="r|", tarinfo=_StrictTarInfo) as tar:
+                                _copy_tar_to_zip(tar, archive, self.cancelled)
+                    # Whatever tar padded the archive with after the end marker
+                    p.stdout.read()
+                except tarfile.ReadError:
+                    # A cut or garbled stream; if tar itself failed, report that instead
+                    if p.poll() is None:
+                        p.kill()
+                    p.wait()
+                    drain.join()
+                    if p.returncode > 0:
+                        raise subprocess.CalledProcessError(p.returncode, cmd, stderr=errors[0])
+                    raise
+                except BaseException:
+                    p.kill()
+                    raise
+                p.wait()
+                drain.join()
+                stderr = errors[0]
+
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, cmd, stderr=stderr)
                 
             logging.info(f"Backup saved to {encrypted_path}")
             
@@ -83,51 +447,126 @@ class BackupManager:
 
         except subprocess.CalledProcessError as e:
             logging.error(f"ADB Pull failed: {e}")
+            if e.stderr:
+                logging.error(e.stderr.decode(errors="replace").strip())
+            if os.path.exists(encrypted_path):
+                os.remove(encrypted_path)
             return None
         except Exception as e:
             logging.error(f"Backup failed: {e}")
+            # Don't leave a truncated archive behind
+            if os.path.exists(encrypted_path):
+                os.remove(encrypted_path)
             return None
-        finally:
-            # Cleanup
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-            if os.path.exists(f"{temp_dir}.zip"):
-                os.remove(f"{temp_dir}.zip")
+
+    @classmethod
+    def backup_devices_parallel(cls, device_ids, source_path, dest_folder="backups", compression=None):
+        """
+        Backs up the same source path from several devices at once, one
+        process per device so each gets its own adb client and encrypts
+        without sharing the GIL. A failure on one device doesn't stop the others.
+        Returns a dict of device_id -> backup path (None if it failed).
+        """
+        if not device_ids:
+            return {}
+        # Create the key up front so the workers don't each generate their own
+        cls(device_ids[0])._get_key()
+
+        results = {}
+        with ProcessPoolExecutor(max_workers=len(device_ids)) as pool:
+            futures = {
+                device_id: pool.submit(_backup_device_worker, device_id, source_path, dest_folder, compression)
+                for device_id in device_ids
+            }
+            for device_id, future in futures.items():
+                try:
+                    results[device_id] = future.result()
+                except Exception as e:
+                    logging.error(f"Backup of {device_id} failed: {e}")
+                    results[device_id] = None
+        return results
 
     def decrypt_backup(self, encrypted_path, output_path=None):
         """
         Decrypts an encrypted backup file.
         If output_path is not provided, saves as zip in the same folder.
         """
+        if not output_path:
+            output_path = os.path.splitext(encrypted_path)[0] + ".zip"
+        try:
+            same_file = os.path.samefile(encrypted_path, output_path)
+        except OSError:
+            same_file = False
+        if same_file:
+            logging.error(f"Decryption failed: output path {output_path} is the backup itself.")
+            return None
+
+        temp_path = None
         try:
             logging.info(f"Decrypting {encrypted_path}...")
             key = self._get_key()
-            f = Fernet(key)
             
-            with open(encrypted_path, "rb") as file:
-                encrypted_data = file.read()
-                
-            decrypted_data = f.decrypt(encrypted_data)
-            
-            if not output_path:
-                output_path = encrypted_path.replace(".enc", ".zip")
-                
-            with open(output_path, "wb") as file:
-                file.write(decrypted_data)
+            # Large buffers on both ends so every chunk costs one read and
+            # at most one write syscall
+            with open(encrypted_path, "rb", buffering=FRAME_SIZE) as file:
+                is_stream = file.read(1) == STREAM_VERSION
+                file.seek(0)
+
+                # Decrypt next to the output and only move it into place once
+                # it's complete, so a failure never clobbers an existing file
+                fd, temp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(output_path)), suffix=".part"
+                )
+                with open(fd, "wb", buffering=WRITE_BUFFER_SIZE) as out:
+                    if is_stream:
+                        _decrypt_stream(self._get_cipher(), file, out, self.cancelled)
+                    else:
+                        # Legacy backups are a single Fernet token
+                        _decrypt_fernet_stream(key, file, out, self.cancelled)
+            os.replace(temp_path, output_path)
                 
             logging.info(f"Decrypted file saved to {output_path}")
             return output_path
         except Exception as e:
             logging.error(f"Decryption failed: {e}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
             return None
 
+    def _query_content(self, uri, projection, pattern):
+        """
+        Streams `adb shell content query` output, yielding a match per row
+        as it arrives instead of buffering the whole result.
+        Raises CalledProcessError if the query fails.
+        """
+        cmd = [
+            "adb", "-s", self.device_id, "shell",
+            "content", "query", "--uri", uri,
+            "--projection", projection
+        ]
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              text=True, bufsize=1 << 16) as p:
+            for line in p.stdout:
+                m = pattern.match(line)
+                if m:
+                    yield m
+            stderr = p.stderr.read()
+        
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd, stderr=stderr)
+
+    def _discard_partial(self, filepath, dest_folder):
+        """Helper to remove a half-written backup file and its empty folder."""
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        self._cleanup_empty_dir(dest_folder)
+
     def backup_contacts(self, dest_folder="backups/contacts"):
         """
         Backs up contacts by querying the contacts content provider.
         Saves as a Standard VCF file (vCard).
         """
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        os.makedirs(dest_folder, exist_ok=True)
             
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"contacts_{self.device_id}_{timestamp}.vcf"
@@ -135,199 +574,113 @@ class BackupManager:
         
         try:
             logging.info(f"Querying contacts from device {self.device_id}...")
-            # Query contacts
-            cmd = [
-                "adb", "-s", self.device_id, "shell", 
-                "content", "query", "--uri", "content://com.android.contacts/data/phones", 
-                "--projection", "display_name:data1"
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True) # check=False manually
+            rows = self._query_content(
+                "content://com.android.contacts/data/phones", "display_name:data1", CONTACT_RE
+            )
+            count = 0
             
-            if result.returncode != 0:
-                logging.error(f"ADB command failed (Exit code {result.returncode}): {result.stderr.strip()}")
-                self._cleanup_empty_dir(dest_folder)
-                return None
-            
-            lines = result.stdout.strip().split('\n')
-            vcard_content = []
-            
-            for line in lines:
-                if "Row:" in line:
-                    parts = line.split(',')
-                    name = ""
-                    phone = ""
-                    
-                    for part in parts:
-                        if "display_name=" in part:
-                            name = part.split("display_name=")[-1].strip()
-                        elif "data1=" in part:
-                            phone = part.split("data1=")[-1].strip()
-                    
+            # vCard 2.1 lines end in CRLF
+            with open(filepath, "w", encoding="utf-8", newline="\r\n") as f:
+                for m in rows:
+                    _check_cancelled(self.cancelled)
+                    name, phone = m.group("name", "phone")
                     if name and phone:
-                        vcard = [
-                            "BEGIN:VCARD",
-                            "VERSION:2.1",
-                            f"FN:{name}",
-                            f"TEL;CELL:{phone}",
-                            "END:VCARD"
-                        ]
-                        vcard_content.append("\n".join(vcard))
+                        f.write(f"BEGIN:VCARD\nVERSION:2.1\nFN:{name}\nTEL;CELL:{phone}\nEND:VCARD\n")
+                        count += 1
             
-            if not vcard_content:
+            if not count:
                 logging.warning("No contacts found.")
-
-            with open(filepath, "w") as f:
-                f.write("\n".join(vcard_content))
                 
             logging.info(f"Contacts saved to {filepath}")
             return filepath
 
+        except subprocess.CalledProcessError as e:
+            logging.error(f"ADB command failed (Exit code {e.returncode}): {e.stderr.strip()}")
+            self._discard_partial(filepath, dest_folder)
+            return None
         except Exception as e:
             logging.error(f"Contacts backup failed: {e}")
-            self._cleanup_empty_dir(dest_folder)
+            self._discard_partial(filepath, dest_folder)
             return None
 
     def backup_sms(self, dest_folder="backups/messages"):
         """
         Backs up SMS by querying the sms content provider.
-        Saves as a JSON file for easy restore.
+        Saves as an NDJSON file (one JSON message per line) for easy restore.
         """
-        import json
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        os.makedirs(dest_folder, exist_ok=True)
             
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"sms_{self.device_id}_{timestamp}.json"
+        filename = f"sms_{self.device_id}_{timestamp}.ndjson"
         filepath = os.path.join(dest_folder, filename)
+        script_path = _sms_script_path(filepath)
         
         try:
             logging.info(f"Querying SMS from device {self.device_id}...")
-            # Query SMS with type
-            cmd = [
-                "adb", "-s", self.device_id, "shell",
-                "content", "query", "--uri", "content://sms",
-                "--projection", "address:date:body:type"
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            # Body goes last, see SMS_RE
+            rows = self._query_content("content://sms", "address:date:type:body", SMS_RE)
             
-            if result.returncode != 0:
-                logging.error(f"ADB command failed (Exit code {result.returncode}): {result.stderr.strip()}")
-                self._cleanup_empty_dir(dest_folder)
-                return None
-            
-            lines = result.stdout.strip().split('\n')
-            sms_list = []
-            
-            for line in lines:
-                if "Row:" in line:
-                    # Basic parser again. 
-                    msg = {"address": "", "date": "0", "body": "", "type": "1"}
-                    
-                    try:
-                        if "address=" in line:
-                            start = line.find("address=") + 8
-                            end = line.find(",", start)
-                            if end == -1: end = len(line)
-                            msg["address"] = line[start:end].strip()
-                        
-                        if "date=" in line:
-                            start = line.find("date=") + 5
-                            end = line.find(",", start)
-                            if end == -1: end = len(line)
-                            msg["date"] = line[start:end].strip()
-
-                        if "type=" in line:
-                            start = line.find("type=") + 5
-                            end = line.find(",", start)
-                            if end == -1: end = len(line)
-                            msg["type"] = line[start:end].strip()
-                        
-                        if "body=" in line:
-                            start = line.find("body=") + 5
-                            # Assuming body is last or we take remaining
-                            msg["body"] = line[start:].strip()
-                    except:
-                        pass
-                    
+            # NDJSON, one message per line, so neither backup nor restore
+            # ever holds the whole list. The sibling script holds the same
+            # messages as ready-to-run insert commands for restore.
+            with open(filepath, "wb") as f, \
+                 open(script_path, "w", encoding="utf-8", newline="\n") as script:
+                script.write(SMS_SCRIPT_MAGIC)
+                for m in rows:
+                    _check_cancelled(self.cancelled)
+                    msg = m.groupdict()
                     if msg["address"] and msg["body"]:
-                        sms_list.append(msg)
-            
-            with open(filepath, "w") as f:
-                json.dump(sms_list, f, indent=4)
+                        f.write(_json_line(msg))
+                        script.write(self._sms_insert_line(msg))
                 
             logging.info(f"SMS saved to {filepath}")
             return filepath
 
+        except subprocess.CalledProcessError as e:
+            logging.error(f"ADB command failed (Exit code {e.returncode}): {e.stderr.strip()}")
+            self._discard_partial(script_path, dest_folder)
+            self._discard_partial(filepath, dest_folder)
+            return None
         except Exception as e:
             logging.error(f"SMS backup failed: {e}")
-            self._cleanup_empty_dir(dest_folder)
+            self._discard_partial(script_path, dest_folder)
+            self._discard_partial(filepath, dest_folder)
             return None
 
     def backup_call_logs(self, dest_folder="backups/call_logs"):
         """
         Backs up Call Logs by querying the call_log content provider.
-        Saves as a JSON file.
+        Saves as an NDJSON file (one JSON call per line).
         """
-        import json
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        os.makedirs(dest_folder, exist_ok=True)
             
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"call_logs_{self.device_id}_{timestamp}.json"
+        filename = f"call_logs_{self.device_id}_{timestamp}.ndjson"
         filepath = os.path.join(dest_folder, filename)
         
         try:
             logging.info(f"Querying Call Logs from device {self.device_id}...")
-            # Query Call Logs
-            cmd = [
-                "adb", "-s", self.device_id, "shell",
-                "content", "query", "--uri", "content://call_log/calls",
-                "--projection", "number:date:duration:type:name"
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                logging.error(f"ADB command failed (Exit code {result.returncode}): {result.stderr.strip()}")
-                self._cleanup_empty_dir(dest_folder)
-                return None
-            
-            lines = result.stdout.strip().split('\n')
-            calls_list = []
+            rows = self._query_content(
+                "content://call_log/calls", "number:date:duration:type:name", CALL_RE
+            )
             
-            for line in lines:
-                if "Row:" in line:
-                    call = {"number": "", "date": "0", "duration": "0", "type": "1", "name": ""}
-                    
-                    try:
-                        # Simple parsing, assuming comma separation isn't broken by content
-                        # A more robust parser might be needed for complex content
-                        parts = line.split(", ")
-                        for part in parts:
-                            if "number=" in part:
-                                call["number"] = part.split("number=")[-1].strip()
-                            elif "date=" in part:
-                                call["date"] = part.split("date=")[-1].strip()
-                            elif "duration=" in part:
-                                call["duration"] = part.split("duration=")[-1].strip()
-                            elif "type=" in part:
-                                call["type"] = part.split("type=")[-1].strip()
-                            elif "name=" in part:
-                                call["name"] = part.split("name=")[-1].strip()
-                    except:
-                        pass
-                    
+            with open(filepath, "wb") as f:
+                for m in rows:
+                    _check_cancelled(self.cancelled)
+                    call = m.groupdict()
                     if call["number"]:
-                        calls_list.append(call)
-            
-            with open(filepath, "w") as f:
-                json.dump(calls_list, f, indent=4)
+                        f.write(_json_line(call))
                 
             logging.info(f"Call Logs saved to {filepath}")
             return filepath
 
+        except subprocess.CalledProcessError as e:
+            logging.error(f"ADB command failed (Exit code {e.returncode}): {e.stderr.strip()}")
+            self._discard_partial(filepath, dest_folder)
+            return None
         except Exception as e:
             logging.error(f"Call Logs backup failed: {e}")
-            self._cleanup_empty_dir(dest_folder)
+            self._discard_partial(filepath, dest_folder)
             return None
 
     def backup_settings(self, dest_folder="backups/settings"):
@@ -335,8 +688,7 @@ class BackupManager:
         Backs up system, global, and secure settings using 'adb shell settings list'.
         Saves as text files.
         """
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        os.makedirs(dest_folder, exist_ok=True)
             
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         base_filename = f"settings_{self.device_id}_{timestamp}"
@@ -348,17 +700,17 @@ class BackupManager:
             logging.info(f"Backing up settings from device {self.device_id}...")
             
             for ns in namespaces:
+                _check_cancelled(self.cancelled)
                 filepath = os.path.join(dest_folder, f"{base_filename}_{ns}.txt")
-                cmd = ["adb", "-s", self.device_id, "shell", "settings", "list", ns]
+                # All namespaces go over the same adb shell session
+                returncode, output = self._shell.run("settings", "list", ns)
                 
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                
-                if result.returncode != 0:
-                    logging.warning(f"Failed to backup {ns} settings: {result.stderr.strip()}")
+                if returncode != 0:
+                    logging.warning(f"Failed to backup {ns} settings: {output.strip()}")
                     continue # Try next namespace
                 
                 with open(filepath, "w") as f:
-                    f.write(result.stdout)
+                    f.write(output + "\n")
                 
                 saved_files.append(filepath)
             
@@ -384,6 +736,83 @@ class BackupManager:
         except Exception:
             pass
 
+    def _iter_sms(self, backup_path):
+        """Yields messages from an SMS backup, one at a time for NDJSON files."""
+        with open(backup_path, "rb") as f:
+            if backup_path.endswith(".json"):
+                yield from json.load(f)
+                return
+            for line in f:
+                if line.strip():
+                    yield _json_loads(line)
+
+    def _sms_script_problem(self, script_path, backup_path):
+        """
+        Checks a prebuilt restore script before it is run on the device.
+        Returns why it can't be used, or None if it holds nothing but SMS
+        inserts and is at least as new as the backup.
+        """
+        if os.path.getmtime(backup_path) > os.path.getmtime(script_path) + SMS_SCRIPT_MTIME_SLACK:
+            return "the backup was changed after the script was written"
+        with open(script_path, encoding="utf-8", newline="\n") as script:
+            if script.readline() != SMS_SCRIPT_MAGIC:
+                return "it wasn't written by Android Backup Buddy"
+            for number, line in enumerate(script, 2):
+                if not SMS_SCRIPT_LINE_RE.fullmatch(line):
+                    return f"line {number} is not an SMS insert"
+        return None
+
+    def _iter_sms_insert_lines(self, backup_path):
+        """
+        Yields the insert command for each message in an SMS backup. Uses the
+        script saved next to the backup when it checks out, so restore is
+        just I/O; otherwise builds the commands from the messages.
+        """
+        script_path = _sms_script_path(backup_path)
+        if os.path.exists(script_path):
+            problem = self._sms_script_problem(script_path, backup_path)
+            if problem is None:
+                logging.info(f"Restoring SMS from prebuilt script {script_path}")
+                with open(script_path, encoding="utf-8", newline="\n") as script:
+                    script.readline()
+                    yield from script
+                return
+            logging.warning(f"Not using {script_path}: {problem}")
+
+        logging.info(f"Restoring SMS from {backup_path}")
+        for msg in self._iter_sms(backup_path):
+            yield self._sms_insert_line(msg)
+
+    def _sms_insert_line(self, msg):
+        """Builds the shell line that restores one SMS message."""
+        binds = [
+            f"address:s:{msg.get('address', '')}",
+            f"body:s:{msg.get('body', '')}",
+            f"date:l:{msg.get('date', '0')}",
+            f"type:i:{msg.get('type', '1')}"
+        ]
+        args = " ".join(f"--bind {_quote_line(b)}" for b in binds)
+        return f"content insert --uri content://sms {args}\n"
+
+    def _run_sms_script(self, lines, batch_no):
+        """Pushes a batch of insert lines as a script and runs it on the device."""
+        remote = f"{SMS_SCRIPT_DIR}/abb_restore_{batch_no}.sh"
+        # newline='\n' so a Windows host doesn't hand the device sh CRLF lines
+        with tempfile.NamedTemporaryFile("w", suffix=".sh", delete=False,
+                                         encoding="utf-8", newline="\n") as script:
+            script.write(SMS_SCRIPT_HEADER)
+            script.writelines(lines)
+        
+        try:
+            subprocess.run(["adb", "-s", self.device_id, "push", script.name, remote],
+                           check=True, capture_output=True)
+            subprocess.run(["adb", "-s", self.device_id, "shell",
+                            f"sh {remote}; rc=$?; rm -f {remote}; exit $rc"],
+                           check=True, capture_output=True)
+        finally:
+            os.remove(script.name)
+        return len(lines)
+
     def restore_backup(self, backup_path, device_dest="/sdcard/"):
         """
         Restores a backup to the device.
@@ -391,9 +820,8 @@ class BackupManager:
         - .enc: Encrypted file zip
         - .zip: Standard backup
         - .vcf: Contacts (Import Intent)
-        - .json: SMS (Content Insert)
+        - .ndjson / .json: SMS (Content Insert)
         """
-        import json
         
         # 1. Handle Contacts (VCF)
         if backup_path.endswith(".vcf"):
@@ -421,37 +849,34 @@ class BackupManager:
                 logging.error(f"Contact Restore failed: {e}")
                 return False
 
-        # 2. Handle SMS (JSON)
-        if backup_path.endswith(".json"):
+        # 2. Handle SMS (NDJSON, or a JSON list from older backups)
+        if backup_path.endswith((".ndjson", ".json")):
             try:
                 logging.info(f"Restoring SMS from {backup_path}...")
-                with open(backup_path, 'r') as f:
-                    messages = json.load(f)
-                
+                print("Restoring messages...")
                 count = 0
-                total = len(messages)
-                print(f"Restoring {total} messages...")
+                batch_no = 0
+                batch = []
+                in_flight = deque()
                 
-                for msg in messages:
-                    # construct content insert command
-                    # escape body for shell
-                    body = msg.get('body', '').replace('"', '\\"').replace("'", "\\'")
-                    address = msg.get('address', '')
-                    date = msg.get('date', '0')
-                    msg_type = msg.get('type', '1')
-                    
-                    cmd = [
-                        "adb", "-s", self.device_id, "shell",
-                        "content", "insert", "--uri", "content://sms",
-                        "--bind", f"address:s:{address}",
-                        "--bind", f"body:s:\"{body}\"",
-                        "--bind", f"date:l:{date}",
-                        "--bind", f"type:i:{msg_type}"
-                    ]
-                    subprocess.run(cmd, check=True, capture_output=True)
-                    count += 1
-                    if count % 10 == 0:
-                        print(f"Restored {count}/{total}...")
+                # One pushed script per batch instead of one adb call per message.
+                # Only a few batches are built ahead so the file is never fully loaded.
+                with ThreadPoolExecutor(max_workers=SMS_RESTORE_WORKERS) as pool:
+                    for line in self._iter_sms_insert_lines(backup_path):
+                        _check_cancelled(self.cancelled)
+                        batch.append(line)
+                        if len(batch) == SMS_SCRIPT_BATCH:
+                            in_flight.append(pool.submit(self._run_sms_script, batch, batch_no))
+                            batch_no += 1
+                            batch = []
+                        if len(in_flight) >= SMS_RESTORE_WORKERS:
+                            count += in_flight.popleft().result()
+                            print(f"Restored {count}...")
+                    if batch:
+                        in_flight.append(pool.submit(self._run_sms_script, batch, batch_no))
+                    while in_flight:
+                        count += in_flight.popleft().result()
+                        print(f"Restored {count}...")
                 
                 logging.info(f"Restored {count} messages.")
                 return True
@@ -460,30 +885,37 @@ class BackupManager:
                 return False
 
         # 3. Handle Standard Backup (Zip/Enc)
-        temp_extract_dir = f"temp_restore_{self.device_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
         try:
-            # Decrypt if needed
-            if backup_path.endswith(".enc"):
-                zip_path = self.decrypt_backup(backup_path)
-                if not zip_path:
-                    return False
-                is_temp_zip = True
-            else:
-                zip_path = backup_path
-                is_temp_zip = False
-            
-            # Unzip
-            logging.info(f"Extracting {zip_path}...")
-            shutil.unpack_archive(zip_path, temp_extract_dir)
-            
-            # Push to device
-            logging.info(f"Restoring data to device {self.device_id} at {device_dest}...")
-            
-            for item in os.listdir(temp_extract_dir):
-                s = os.path.join(temp_extract_dir, item)
-                cmd = ["adb", "-s", self.device_id, "push", s, device_dest]
-                subprocess.run(cmd, check=True, capture_output=True)
+            # Staged next to the backup rather than in the system temp dir,
+            # which is often a RAM-backed tmpfs too small for a full backup
+            staging_dir = os.path.dirname(os.path.abspath(backup_path))
+            with tempfile.TemporaryDirectory(prefix=f"abb_restore_{self.device_id}_", dir=staging_dir) as temp_root:
+                temp_extract_dir = os.path.join(temp_root, "extract")
+
+                # Decrypt if needed, next to the extracted files so it's cleaned up with them
+                if backup_path.endswith(".enc"):
+                    zip_path = self.decrypt_backup(backup_path, os.path.join(temp_root, "backup.zip"))
+                    if not zip_path:
+                        return False
+                else:
+                    zip_path = backup_path
+                
+                # Unzip
+                logging.info(f"Extracting {zip_path}...")
+                shutil.unpack_archive(zip_path, temp_extract_dir)
+                
+                # Push to device
+                logging.info(f"Restoring data to device {self.device_id} at {device_dest}...")
+                
+                def push(item):
+                    _check_cancelled(self.cancelled)
+                    s = os.path.join(temp_extract_dir, item)
+                    cmd = ["adb", "-s", self.device_id, "push", s, device_dest]
+                    subprocess.run(cmd, check=True, capture_output=True)
+                
+                # A single adb push doesn't fill the link; run a few side by side
+                with ThreadPoolExecutor(max_workers=RESTORE_PUSH_WORKERS) as pool:
+                    list(pool.map(push, os.listdir(temp_extract_dir)))
                 
             logging.info("Restore completed successfully.")
             return True
@@ -494,11 +926,6 @@ class BackupManager:
         except Exception as e:
             logging.error(f"Restore failed: {e}")
             return False
-        finally:
-            if os.path.exists(temp_extract_dir):
-                shutil.rmtree(temp_extract_dir)
-            if 'is_temp_zip' in locals() and is_temp_zip and os.path.exists(zip_path):
-                os.remove(zip_path)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
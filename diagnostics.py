@@ -1,59 +1,115 @@
 import subprocess
 import logging
 import os
+import re
+import shlex
 from datetime import datetime
+from shell import AdbShell
+
+# Printed between batched commands to split their output apart again
+BATCH_SEPARATOR = "===ABB_SPLIT==="
+# The separator line, carrying the exit code of the command before it
+BATCH_STATUS_RE = re.compile(rf"\r?\n{BATCH_SEPARATOR} (\d+)\r?\n")
 
 class Diagnostics:
     def __init__(self, device_id):
         self.device_id = device_id
+        # Reused by every single-command query on this device
+        self._shell = AdbShell(device_id)
+
+    def close(self):
+        """Ends this device's adb shell session, if one was started."""
+        self._shell.close()
 
-    def _run_shell_command(self, command):
-        """Runs an ADB shell command on the specific device."""
-        full_command = ["adb", "-s", self.device_id, "shell"] + command.split()
+    def _run_shell_command(self, *args):
+        """Runs an ADB shell command, given as separate arguments, on the specific device."""
+        command = shlex.join(args)
         try:
-            result = subprocess.run(
-                full_command,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            return result.stdout.strip()
-        except subprocess.CalledProcessError as e:
+            returncode, output = self._shell.run(*args)
+        except OSError as e:
             logging.error(f"Error running command '{command}' on device {self.device_id}: {e}")
             return None
+        if returncode != 0:
+            logging.error(f"Error running command '{command}' on device {self.device_id}: exit code {returncode}: {output}")
+            return None
+        return output.strip()
+
+    def _run_shell_batch(self, commands):
+        """
+        Runs several shell commands (each a list of arguments) in a single
+        ADB round-trip. Returns one output per command; each command that
+        fails, or never ran, gets None on its own.
+        """
+        # Each command is followed by a status line with its own exit code
+        script = "".join(
+            f"{shlex.join(c)}; printf '\\n{BATCH_SEPARATOR} %d\\n' $?; " for c in commands
+        )
+        full_command = ["adb", "-s", self.device_id, "shell", script]
+        result = subprocess.run(full_command, capture_output=True, text=True)
+
+        # [output, status, output, status, ..., trailing]
+        parts = BATCH_STATUS_RE.split(result.stdout)
+        finished = (len(parts) - 1) // 2
+        if finished < len(commands):
+            logging.error(
+                f"Batched commands on device {self.device_id} stopped after {finished} of "
+                f"{len(commands)} (adb exit code {result.returncode}): {result.stderr.strip()}"
+            )
+
+        outputs = []
+        for i, args in enumerate(commands):
+            if i >= finished:
+                outputs.append(None)
+                continue
+            output, returncode = parts[2 * i].strip(), int(parts[2 * i + 1])
+            if returncode != 0:
+                logging.error(f"Error running command '{shlex.join(args)}' on device {self.device_id}: exit code {returncode}: {output}")
+                outputs.append(None)
+            else:
+                outputs.append(output)
+        return outputs
 
     def get_device_info(self):
         """Retrieves model and Android version."""
-        model = self._run_shell_command("getprop ro.product.model")
-        version = self._run_shell_command("getprop ro.build.version.release")
+        model = self._run_shell_command("getprop", "ro.product.model")
+        version = self._run_shell_command("getprop", "ro.build.version.release")
         return {"model": model, "version": version}
 
     def get_battery_status(self):
         """Retrieves battery level and status."""
-        # Simple parsing of dumpsys battery
-        output = self._run_shell_command("dumpsys battery")
+        return self._parse_battery(self._run_shell_command("dumpsys", "battery"))
+
+    def _parse_battery(self, output):
+        """Parses `dumpsys battery` output."""
         if not output:
             return {}
         
-        info = {}
+        # One "key: value" per line; build the map once, then pick fields
+        fields = {}
         for line in output.split('\n'):
-            line = line.strip()
-            if "level" in line:
-                info['level'] = line.split(':')[-1].strip()
-            elif "status" in line:
-                 # Status codes: 1: Unknown, 2: Charging, 3: Discharging, 4: Not charging, 5: Full
-                status_code = line.split(':')[-1].strip()
-                status_map = {
-                    '1': 'Unknown', '2': 'Charging', '3': 'Discharging', 
-                    '4': 'Not Charging', '5': 'Full'
-                }
-                info['status'] = status_map.get(status_code, status_code)
+            key, sep, value = line.partition(':')
+            if sep:
+                fields[key.strip()] = value.strip()
+
+        # Status codes: 1: Unknown, 2: Charging, 3: Discharging, 4: Not charging, 5: Full
+        status_map = {
+            '1': 'Unknown', '2': 'Charging', '3': 'Discharging', 
+            '4': 'Not Charging', '5': 'Full'
+        }
+        info = {}
+        if 'level' in fields:
+            info['level'] = fields['level']
+        if 'status' in fields:
+            info['status'] = status_map.get(fields['status'], fields['status'])
         return info
 
     def get_storage_info(self):
         """Retrieves storage info for /data partition."""
         # focused on internal storage /data
-        output = self._run_shell_command("df /data")
+        return self._parse_storage(self._run_shell_command("df", "/data"))
+
+    def _parse_storage(self, output):
+        """Parses `df /data` output."""
         if not output:
             return {}
         
@@ -73,12 +129,18 @@ class Diagnostics:
 
     def generate_report(self, output_dir="reports"):
         """Generates a text report with diagnostics info."""
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
 
-        info = self.get_device_info()
-        battery = self.get_battery_status()
-        storage = self.get_storage_info()
+        # One adb call for everything instead of one per command
+        model, version, battery_out, storage_out = self._run_shell_batch([
+            ["getprop", "ro.product.model"],
+            ["getprop", "ro.build.version.release"],
+            ["dumpsys", "battery"],
+            ["df", "/data"]
+        ])
+        info = {"model": model, "version": version}
+        battery = self._parse_battery(battery_out)
+        storage = self._parse_storage(storage_out)
         
         report_content = [
             f"Diagnostics Report for Device: {self.device_id}",
@@ -1,9 +1,63 @@
-import argparse
 import logging
+import os
+import shutil
+import stat
 import sys
-from detector import get_connected_devices
-from diagnostics import Diagnostics
-from backup import BackupManager
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+
+# detector, diagnostics and backup are imported where they are first
+# needed, so the menu and --detect start without loading the crypto stack
+
+REPORT_COPY_SIZE = 64 * 1024
+# Backup menu choices: folders archived from the device...
+BACKUP_SOURCES = {'1': "/sdcard/DCIM", '2': "/sdcard"}
+# ...and text dumps, as (BackupManager method, label)
+BACKUP_HANDLERS = {
+    '3': ("backup_contacts", "Contacts"),
+    '4': ("backup_sms", "SMS"),
+    '5': ("backup_call_logs", "Call Logs"),
+    '6': ("backup_settings", "Mobile Settings"),
+}
+
+# Seconds between spinner frames while a long operation runs
+SPINNER_INTERVAL = 0.25
+
+# How long an `adb devices` result is reused before polling adb again
+DEVICE_CACHE_TTL = 2.0
+
+# Each menu is written to stdout in one call
+MAIN_MENU = (
+    "\n=== Android Backup Buddy ===\n"
+    "1. Detect Device\n"
+    "2. Rescan Devices\n"
+    "0. Close\n"
+)
+DEVICE_MENU = (
+    "\n--- Menu for {device} ---\n"
+    "1. Device Report\n"
+    "2. Device Backup\n"
+    "3. Restore Backup\n"
+    "4. Developer Options (Decrypt Backup)\n"
+    "0. Back to Main Menu\n"
+)
+BACKUP_MENU = (
+    "\n--- Backup Selection ---\n"
+    "1. Pic Only (Backs up /sdcard/DCIM)\n"
+    "2. All Data (Backs up /sdcard)\n"
+    "3. Contacts (Text Dump)\n"
+    "4. SMS (Text Dump)\n"
+    "5. Call Logs (Text Dump)\n"
+    "6. Mobile Settings (System/Global/Secure)\n"
+)
+RESTORE_MENU = (
+    "\n--- Restore Backup ---\n"
+    "Supported formats: .enc (Encrypted Zip), .zip (Standard), .vcf (Contacts), .ndjson/.json (SMS)\n"
+)
+DEVELOPER_MENU = (
+    "\n--- Developer Options ---\n"
+    "1. Decrypt Backup File\n"
+)
 
 def setup_logging():
     logging.basicConfig(
@@ -14,19 +68,131 @@ def setup_logging():
         ]
     )
 
+# Long backup/restore/decrypt calls run here so the menu can show progress
+_pool = ThreadPoolExecutor(max_workers=1)
+
+_device_cache = {"ts": 0.0, "val": None}
+
+def _devices(ttl=DEVICE_CACHE_TTL):
+    """Connected devices, re-polled from adb at most once every `ttl` seconds."""
+    now = time.monotonic()
+    if _device_cache["val"] is None or now - _device_cache["ts"] > ttl:
+        from detector import get_connected_devices
+        _device_cache["val"] = get_connected_devices()
+        _device_cache["ts"] = now
+    return _device_cache["val"]
+
+def _report(res, label):
+    """Prints the outcome of a backup; `res` is a file path, a list of them, or None."""
+    if not res:
+        print(f"{label} failed.")
+    elif isinstance(res, list):
+        print(f"{label} Complete! Saved to: {os.path.dirname(res[0])}")
+        for f in res:
+            print(f" - {os.path.basename(f)}")
+    else:
+        print(f"{label} Complete! File: {res}")
+
+def _sendfile_to_stdout(f):
+    """
+    Copies the open file `f` to stdout in the kernel when stdout is a
+    regular file or a pipe (e.g. `--diagnose > report.txt`).
+    Returns False, having sent nothing, if that isn't possible here.
+    """
+    sent = 0
+    try:
+        out_fd = sys.stdout.fileno()
+        mode = os.fstat(out_fd).st_mode
+        if not (stat.S_ISREG(mode) or stat.S_ISFIFO(mode)):
+            return False
+        size = os.fstat(f.fileno()).st_size
+        while sent < size:
+            n = os.sendfile(out_fd, f.fileno(), sent, size - sent)
+            if not n:
+                break
+            sent += n
+    except (AttributeError, OSError) as e:
+        # No os.sendfile (Windows), no real stdout fd, or fds it can't join
+        if not sent:
+            return False
+        # Part of the report is already out; don't send it twice
+        logging.warning(f"Report output cut short after {sent} bytes: {e}")
+    return True
+
+def _write_report(path):
+    """Writes a saved report to stdout without reading it into memory."""
+    # Anything already buffered has to reach the fd before the report does
+    sys.stdout.flush()
+    with open(path, 'rb') as f:
+        sent = _sendfile_to_stdout(f)
+    if not sent:
+        with open(path, 'r', buffering=REPORT_COPY_SIZE) as f:
+            shutil.copyfileobj(f, sys.stdout, REPORT_COPY_SIZE)
+    # The report has no trailing newline
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+def _run_with_spinner(cancelled, fn, *args):
+    """
+    Runs fn(*args) on the worker thread and returns its result, showing a
+    spinner on a terminal until it finishes. On Ctrl-C, sets the
+    `cancelled` event, waits for the job to stop and clean up, then
+    re-raises KeyboardInterrupt.
+    """
+    cancelled.clear()
+    future = _pool.submit(fn, *args)
+    show = sys.stdout.isatty()
+    spinner = "|/-\\"
+    i = 0
+    try:
+        # Always poll with a timeout so Ctrl-C is noticed promptly
+        while True:
+            try:
+                return future.result(timeout=SPINNER_INTERVAL)
+            except FutureTimeoutError:
+                if show:
+                    # Return to column 0 so log lines written meanwhile overwrite the spinner
+                    sys.stdout.write(f"{spinner[i & 3]} working...\r")
+                    sys.stdout.flush()
+                    i += 1
+    except KeyboardInterrupt:
+        if not future.cancel():
+            print("\nCancelling, please wait...")
+            cancelled.set()
+            wait([future])
+        raise
+    finally:
+        if show:
+            sys.stdout.write(" " * 20 + "\r")
+            sys.stdout.flush()
+
+def _read_line(prompt):
+    """
+    input() for piped stdin: a plain readline without the line-editing and
+    prompt handling. Raises EOFError at end of input, like input().
+    """
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line.rstrip("\n")
+
 def interactive_mode():
+    read = input if sys.stdin.isatty() else _read_line
     while True:
-        print("\n=== Android Backup Buddy ===")
-        print("1. Detect Device")
-        print("0. Close")
+        sys.stdout.write(MAIN_MENU)
         
-        choice = input("Select an option: ").strip()
+        choice = read("Select an option: ").strip()
         
         if choice == '0':
             print("Goodbye!")
             sys.exit(0)
-        elif choice == '1':
-            devices = get_connected_devices()
+        elif choice in ('1', '2'):
+            if choice == '2':
+                # Force a fresh `adb devices`
+                _device_cache["val"] = None
+            devices = _devices()
             if not devices:
                 print("No devices found.")
                 continue
@@ -36,12 +202,12 @@ def interactive_mode():
                 selected_device = devices[0]['id']
                 print(f"Device detected: {selected_device}")
             else:
-                print("\nMultiple devices found:")
-                for idx, d in enumerate(devices):
-                    print(f"{idx + 1}. {d['id']} ({d['status']})")
+                sys.stdout.write("\nMultiple devices found:\n" + "".join(
+                    f"{idx + 1}. {d['id']} ({d['status']})\n" for idx, d in enumerate(devices)
+                ))
                 
                 try:
-                    sel = int(input("Select device number: "))
+                    sel = int(read("Select device number: "))
                     if 1 <= sel <= len(devices):
                         selected_device = devices[sel-1]['id']
                     else:
@@ -51,111 +217,66 @@ def interactive_mode():
                     print("Invalid input.")
                     continue
             
+            # One instance per device for the whole menu session, so the adb
+            # shell session, key and cipher are set up once and reused
+            from backup import BackupManager
+            from diagnostics import Diagnostics
+            bm = BackupManager(selected_device)
+            diag = Diagnostics(selected_device)
+
             # Secondary Menu
             while True:
-                print(f"\n--- Menu for {selected_device} ---")
-                print("1. Device Report")
-                print("2. Device Backup")
-                print("3. Restore Backup")
-                print("4. Developer Options (Decrypt Backup)")
-                print("0. Back to Main Menu")
+                sys.stdout.write(DEVICE_MENU.format(device=selected_device))
                 
-                sub_choice = input("Select an option: ").strip()
+                sub_choice = read("Select an option: ").strip()
                 
                 if sub_choice == '0':
+                    # Leaving this device; end its adb shell sessions
+                    bm.close()
+                    diag.close()
                     break
                 elif sub_choice == '1':
                     # Report
                     print("Generating report...")
-                    diag = Diagnostics(selected_device)
                     # Use default 'reports' folder logic in diagnostics.py
                     path = diag.generate_report()
                     if path:
                         print(f"Report saved: {path}")
                         print("--- Report Content ---")
                         try:
-                            with open(path, 'r') as f:
-                                print(f.read())
-                        except:
-                            pass
+                            _write_report(path)
+                        except OSError as e:
+                            logging.warning(f"Could not display report: {e}")
                         print("----------------------")
                 elif sub_choice == '2':
                     # Backup
-                    print("\n--- Backup Selection ---")
-                    print("1. Pic Only (Backs up /sdcard/DCIM)")
-                    print("2. All Data (Backs up /sdcard)")
-                    print("3. Contacts (Text Dump)")
-                    print("4. SMS (Text Dump)")
-                    print("5. Call Logs (Text Dump)")
-                    print("6. Mobile Settings (System/Global/Secure)")
-                    
-                    bk_choice = input("Select backup type: ").strip()
-                    source = None
-                    
-                    if bk_choice == '1':
-                        source = "/sdcard/DCIM"
-                    elif bk_choice == '2':
-                        source = "/sdcard"
-                    elif bk_choice == '3':
-                        print("Backing up contacts...")
-                        bm = BackupManager(selected_device)
-                        res = bm.backup_contacts() # Defaults to backups/contacts
-                        if res:
-                            print(f"Contacts Backup Complete! File: {res}")
-                        else:
-                            print("Contacts Backup failed.")
-                        continue # Skip the general source logic
-                    elif bk_choice == '4':
-                        print("Backing up SMS...")
-                        bm = BackupManager(selected_device)
-                        res = bm.backup_sms() # Defaults to backups/messages
-                        if res:
-                            print(f"SMS Backup Complete! File: {res}")
-                        else:
-                            print("SMS Backup failed.")
-                        continue
-                    elif bk_choice == '5':
-                        print("Backing up Call Logs...")
-                        bm = BackupManager(selected_device)
-                        res = bm.backup_call_logs() # Defaults to backups/call_logs
-                        if res:
-                            print(f"Call Logs Backup Complete! File: {res}")
-                        else:
-                            print("Call Logs Backup failed.")
-                        continue
-                    elif bk_choice == '6':
-                        print("Backing up Mobile Settings...")
-                        bm = BackupManager(selected_device)
-                        res = bm.backup_settings() # Defaults to backups/settings
-                        if res:
-                            print(f"Mobile Settings Backup Complete! Saved to: {os.path.dirname(res[0])}")
-                            for f in res:
-                                print(f" - {os.path.basename(f)}")
-                        else:
-                            print("Mobile Settings Backup failed.")
-                        continue
+                    sys.stdout.write(BACKUP_MENU)
                     
+                    bk_choice = read("Select backup type: ").strip()
+                    source = BACKUP_SOURCES.get(bk_choice)
+                    handler = BACKUP_HANDLERS.get(bk_choice)
+
                     if source:
                         print(f"Starting backup of {source}...")
-                        bm = BackupManager(selected_device)
-                        res = bm.backup_device(source, "backups")
+                        res = _run_with_spinner(bm.cancelled, bm.backup_device, source, "backups")
+                        _report(res, "Backup")
                         if res:
-                            print(f"Backup Complete! File: {res}")
                             print("Encryption key 'backup_key.key' is in the current directory.")
-                        else:
-                            print("Backup failed.")
+                    elif handler:
+                        # Text dumps, saved under backups/<type> by default
+                        method, label = handler
+                        print(f"Backing up {label}...")
+                        _report(_run_with_spinner(bm.cancelled, getattr(bm, method)), f"{label} Backup")
                     else:
                         print("Invalid backup selection.")
-                        
+
                 elif sub_choice == '3':
                     # Restore
-                    print("\n--- Restore Backup ---")
-                    print("Supported formats: .enc (Encrypted Zip), .zip (Standard), .vcf (Contacts), .json (SMS)")
-                    backup_path = input("Enter path to backup file: ").strip()
+                    sys.stdout.write(RESTORE_MENU)
+                    backup_path = read("Enter path to backup file: ").strip()
                     if os.path.exists(backup_path):
                         print(f"Restoring {backup_path} to device...")
-                        bm = BackupManager(selected_device)
-                        if bm.restore_backup(backup_path):
+                        if _run_with_spinner(bm.cancelled, bm.restore_backup, backup_path):
                             print("Restore Completed Successfully!")
                         else:
                             print("Restore Failed.")
@@ -164,15 +285,13 @@ def interactive_mode():
                 
                 elif sub_choice == '4':
                     # Developer Options
-                    print("\n--- Developer Options ---")
-                    print("1. Decrypt Backup File")
-                    dev_choice = input("Select option: ").strip()
+                    sys.stdout.write(DEVELOPER_MENU)
+                    dev_choice = read("Select option: ").strip()
                     
                     if dev_choice == '1':
-                        enc_path = input("Enter path to encrypted file (.enc): ").strip()
+                        enc_path = read("Enter path to encrypted file (.enc): ").strip()
                         if os.path.exists(enc_path):
-                            bm = BackupManager(selected_device)
-                            out = bm.decrypt_backup(enc_path)
+                            out = _run_with_spinner(bm.cancelled, bm.decrypt_backup, enc_path)
                             if out:
                                 print(f"File decrypted successfully: {out}")
                             else:
@@ -180,6 +299,16 @@ def interactive_mode():
                         else:
                             print("File not found.")
 
+def _print_devices():
+    """Prints the connected devices for --detect."""
+    devices = _devices()
+    if not devices:
+        print("No devices found.")
+    else:
+        print("Connected Devices:")
+        for d in devices:
+            print(f"  - ID: {d['id']} | Status: {d['status']}")
+
 def main():
     setup_logging()
     
@@ -187,12 +316,18 @@ def main():
     if len(sys.argv) == 1:
         try:
             interactive_mode()
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError):
             print("\nExiting...")
             sys.exit(0)
         return
 
+    # Plain `--detect` is polled by scripts; answer it without building the parser
+    if sys.argv[1:] == ["--detect"]:
+        _print_devices()
+        return
+
     # Existing Argument Parser Logic
+    import argparse
     parser = argparse.ArgumentParser(description="Android Backup Buddy - IT Diagnostics & Backup Tool")
     
     parser.add_argument("--detect", action="store_true", help="Detect connected devices")
@@ -200,26 +335,22 @@ def main():
     parser.add_argument("--backup", action="store_true", help="Perform secure backup")
     
     parser.add_argument("--device-id", type=str, help="Target device ID (required for multiple devices)")
+    parser.add_argument("--all-devices", action="store_true", help="With --backup, back up every connected device in parallel")
     parser.add_argument("--source", type=str, default="/sdcard/DCIM", help="Source path on device for backup (default: /sdcard/DCIM)")
     parser.add_argument("--dest", type=str, default="backups", help="Local destination folder for backups")
+    parser.add_argument("--compression", choices=["zstd"], help="Compress the backup archive (requires 'zstandard'); default stores files uncompressed")
     
     args = parser.parse_args()
     
     # 1. Device Detection
     if args.detect:
-        devices = get_connected_devices()
-        if not devices:
-            print("No devices found.")
-        else:
-            print("Connected Devices:")
-            for d in devices:
-                print(f"  - ID: {d['id']} | Status: {d['status']}")
+        _print_devices()
         return
 
     # Helper: Resolve Device ID
     device_id = args.device_id
-    if (args.diagnose or args.backup) and not device_id:
-        devices = get_connected_devices()
+    if (args.diagnose or (args.backup and not args.all_devices)) and not device_id:
+        devices = _devices()
         if not devices:
             logging.error("No devices found. Connect a device first.")
             return
@@ -236,21 +367,40 @@ def main():
     # 2. Diagnostics
     if args.diagnose:
         logging.info(f"Running diagnostics for {device_id}...")
+        from diagnostics import Diagnostics
         diag = Diagnostics(device_id)
         report_path = diag.generate_report()
+        diag.close()
         if report_path:
             print("-" * 30)
-            # Read and print report content for immediate feedback
-            with open(report_path, 'r') as f:
-                print(f.read())
+            # Stream the report out for immediate feedback
+            _write_report(report_path)
             print(f"Report saved to: {report_path}")
             print("-" * 30)
     
     # 3. Backup
     if args.backup:
+        from backup import BackupManager
+
+    if args.backup and args.all_devices:
+        device_ids = [d['id'] for d in _devices() if d['status'] == 'device']
+        if not device_ids:
+            logging.error("No devices found. Connect a device first.")
+            return
+        logging.info(f"Starting parallel backup for {len(device_ids)} devices...")
+        results = BackupManager.backup_devices_parallel(device_ids, args.source, args.dest, args.compression)
+        for d_id, encrypted_file in results.items():
+            if encrypted_file:
+                print(f"{d_id}: Backup completed successfully: {encrypted_file}")
+            else:
+                print(f"{d_id}: Backup failed.")
+        if any(results.values()):
+            print(f"Encryption key saved in current directory as 'backup_key.key'. KEEP THIS SAFE!")
+    elif args.backup:
         logging.info(f"Starting backup for {device_id}...")
         bm = BackupManager(device_id)
-        encrypted_file = bm.backup_device(args.source, args.dest)
+        encrypted_file = bm.backup_device(args.source, args.dest, args.compression)
+        bm.close()
         if encrypted_file:
             print(f"Backup completed successfully: {encrypted_file}")
             print(f"Encryption key saved in current directory as 'backup_key.key'. KEEP THIS SAFE!")
@@ -0,0 +1,89 @@
+import subprocess
+import logging
+import shlex
+import uuid
+
+# Start of the status line printed after every command
+MARKER_PREFIX = "__ABB_"
+
+class AdbShell:
+    """
+    A persistent `adb shell` session for one device.
+    Commands are written to the shell's stdin and read back up to a marker
+    line, so a series of commands shares one adb process and connection
+    instead of forking a new client per command.
+    """
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self._proc = None
+
+    def _session(self):
+        """Starts the session on first use, or again if adb has exited."""
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(
+                ["adb", "-s", self.device_id, "shell"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1
+            )
+        return self._proc
+
+    def run(self, *args):
+        """
+        Runs a command, given as separate arguments, in the session.
+        Returns (exit_code, output) with stderr merged into the output.
+        Raises OSError if the session drops (device unplugged, unauthorized...).
+        """
+        proc = self._session()
+        token = uuid.uuid4().hex
+        marker = f"{MARKER_PREFIX}{token}"
+        # The marker is assembled by printf on the device, so a session that
+        # echoes its input never shows it; the leading newline puts it at the
+        # start of a line even when the output has no trailing newline.
+        # </dev/null so a command can't swallow the commands queued after it
+        command = f"{shlex.join(args)} </dev/null 2>&1; printf '\\n%s%s %d\\n' {MARKER_PREFIX} {token} $?"
+        proc.stdin.write(command + "\n")
+        proc.stdin.flush()
+
+        lines = []
+        for line in proc.stdout:
+            line = line.rstrip("\r\n")
+            if not lines and line == command:
+                # Echoed back by a session running on a pty
+                continue
+            if line.startswith(marker):
+                # Drop the line break printed ahead of the marker
+                if lines and not lines[-1]:
+                    lines.pop()
+                try:
+                    return int(line[len(marker):]), "\n".join(lines)
+                except ValueError:
+                    self.close()
+                    raise OSError(f"adb shell session to {self.device_id} sent a bad status line: {line!r}")
+            lines.append(line)
+
+        self.close()
+        raise OSError(f"adb shell session to {self.device_id} ended: {' '.join(lines)}")
+
+    def close(self):
+        """Ends the session."""
+        if self._proc is None:
+            return
+        try:
+            if self._proc.poll() is None:
+                self._proc.stdin.write("exit\n")
+                self._proc.stdin.close()
+                self._proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.warning(f"adb shell session to {self.device_id} did not exit cleanly: {e}")
+            self._proc.kill()
+            self._proc.wait()
+        for pipe in (self._proc.stdin, self._proc.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                # stdin may still hold unsent input for a dead session
+                pass
+        self._proc = None
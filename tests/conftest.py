@@ -0,0 +1,36 @@
+import os
+import stat
+import sys
+
+import pytest
+
+# The modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# `adb shell` runs a local sh: interactively with no command (extra sh flags
+# from FAKE_ADB_SH_FLAGS), otherwise the joined command line, like adbd does
+FAKE_ADB = """#!/bin/sh
+[ "$1" = "-s" ] && shift 2
+case "$1" in
+  shell)
+    shift
+    [ $# -eq 0 ] && exec sh $FAKE_ADB_SH_FLAGS
+    exec sh -c "$*" ;;
+  features) echo "shell_v2,cmd" ;;
+esac
+exit 1
+"""
+
+
+@pytest.fixture
+def adb_sh(tmp_path, monkeypatch):
+    """Puts a fake adb on PATH whose device is the local shell."""
+    if os.name == "nt":
+        pytest.skip("needs a POSIX sh")
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    adb = bin_dir / "adb"
+    adb.write_text(FAKE_ADB)
+    adb.chmod(adb.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return adb
@@ -0,0 +1,312 @@
+import base64
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import backup
+from backup import CHUNK_SIZE, FRAME_SIZE, NONCE_SIZE, STREAM_HEADER_SIZE, TAG_SIZE
+
+SIZES = [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE + 12345]
+
+needs_zstd = pytest.mark.skipif(backup.zstandard is None, reason="zstandard not installed")
+
+
+def new_key():
+    return base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=256))
+
+
+def cipher(key):
+    return AESGCM(base64.urlsafe_b64decode(key))
+
+
+def encrypt(path, key, data, compression=None):
+    # Odd-sized writes so frames never line up with the caller's writes
+    with backup._EncryptedWriter(path, cipher(key), compression) as w:
+        for i in range(0, len(data), 100_000):
+            w.write(data[i:i + 100_000])
+
+
+def decrypt(path, key):
+    out = io.BytesIO()
+    with open(path, "rb") as f:
+        backup._decrypt_stream(cipher(key), f, out)
+    return out.getvalue()
+
+
+def split_frames(raw):
+    """Splits an uncompressed stream file into header and frames."""
+    header, body = raw[:STREAM_HEADER_SIZE], raw[STREAM_HEADER_SIZE:]
+    return header, [body[i:i + FRAME_SIZE] for i in range(0, len(body), FRAME_SIZE)]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip(tmp_path, size):
+    key = new_key()
+    data = os.urandom(size)
+    path = tmp_path / "b.enc"
+    encrypt(path, key, data)
+    assert decrypt(path, key) == data
+
+
+@needs_zstd
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip_zstd(tmp_path, size):
+    key = new_key()
+    # Half random so the compressed stream still spans several frames
+    data = (os.urandom(size // 2) + bytes(size))[:size]
+    path = tmp_path / "b.enc"
+    encrypt(path, key, data, "zstd")
+    assert decrypt(path, key) == data
+
+
+def test_exact_chunk_ends_with_empty_frame(tmp_path):
+    key = new_key()
+    path = tmp_path / "b.enc"
+    encrypt(path, key, os.urandom(CHUNK_SIZE))
+    _, frames = split_frames(path.read_bytes())
+    assert [len(f) for f in frames] == [FRAME_SIZE, NONCE_SIZE + TAG_SIZE]
+
+
+def test_legacy_fernet_token():
+    key = new_key()
+    data = os.urandom(2 * CHUNK_SIZE + 777)
+    out = io.BytesIO()
+    backup._decrypt_fernet_stream(key, io.BytesIO(Fernet(key).encrypt(data)), out)
+    assert out.getvalue() == data
+
+
+def test_legacy_fernet_tampered():
+    key = new_key()
+    token = bytearray(base64.urlsafe_b64decode(Fernet(key).encrypt(b"x" * 1000)))
+    token[40] ^= 1
+    with pytest.raises(ValueError):
+        backup._decrypt_fernet_stream(key, io.BytesIO(base64.urlsafe_b64encode(token)), io.BytesIO())
+
+
+@pytest.fixture
+def three_frames(tmp_path):
+    key = new_key()
+    path = tmp_path / "b.enc"
+    encrypt(path, key, os.urandom(2 * CHUNK_SIZE + 10))
+    header, frames = split_frames(path.read_bytes())
+    assert len(frames) == 3
+    return key, path, header, frames
+
+
+def test_rejects_file_cut_on_frame_boundary(three_frames):
+    key, path, header, frames = three_frames
+    path.write_bytes(header + b"".join(frames[:2]))
+    with pytest.raises(ValueError):
+        decrypt(path, key)
+
+
+def test_rejects_file_cut_mid_frame(three_frames):
+    key, path, header, frames = three_frames
+    path.write_bytes(header + frames[0] + frames[1][:1000])
+    with pytest.raises(ValueError):
+        decrypt(path, key)
+
+
+def test_rejects_reordered_frames(three_frames):
+    key, path, header, frames = three_frames
+    path.write_bytes(header + frames[1] + frames[0] + frames[2])
+    with pytest.raises(ValueError):
+        decrypt(path, key)
+
+
+def test_rejects_wrong_key(three_frames):
+    _, path, _, _ = three_frames
+    with pytest.raises(ValueError):
+        decrypt(path, new_key())
+
+
+def test_decrypt_backup_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bm = backup.BackupManager("test")
+    data = os.urandom(CHUNK_SIZE + 5)
+    encrypt("b.enc", bm._get_key(), data)
+    assert bm.decrypt_backup("b.enc") == "b.zip"
+    assert (tmp_path / "b.zip").read_bytes() == data
+
+
+def test_decrypt_backup_failure_keeps_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bm = backup.BackupManager("test")
+    encrypt("b.enc", new_key(), b"data")
+    (tmp_path / "b.zip").write_bytes(b"keep")
+    assert bm.decrypt_backup("b.enc") is None
+    assert (tmp_path / "b.zip").read_bytes() == b"keep"
+    assert sorted(os.listdir(tmp_path)) == ["b.enc", "b.zip", "backup_key.key"]
+
+
+def test_decrypt_backup_never_overwrites_input(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bm = backup.BackupManager("test")
+    encrypt("mybackup.bin", bm._get_key(), b"data")
+    raw = (tmp_path / "mybackup.bin").read_bytes()
+    assert bm.decrypt_backup("mybackup.bin", "mybackup.bin") is None
+    assert (tmp_path / "mybackup.bin").read_bytes() == raw
+
+
+def make_tar(names):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name in names:
+            data = name.encode() * 300
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def copy_tar(raw):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as archive:
+        with tarfile.open(fileobj=io.BytesIO(raw), mode="r|", tarinfo=backup._StrictTarInfo) as tar:
+            backup._copy_tar_to_zip(tar, archive)
+    return zipfile.ZipFile(out).namelist()
+
+
+# One 512-byte header plus the data padded to a block
+FIRST_MEMBER_END = 512 + 1024
+
+
+def test_tar_copy():
+    assert copy_tar(make_tar(["a.jpg", "b.jpg", "c.jpg"])) == ["a.jpg", "b.jpg", "c.jpg"]
+
+
+def test_tar_cut_on_member_boundary():
+    with pytest.raises(tarfile.ReadError):
+        copy_tar(make_tar(["a.jpg", "b.jpg", "c.jpg"])[:FIRST_MEMBER_END])
+
+
+def test_tar_with_error_text_mixed_in():
+    raw = make_tar(["a.jpg", "b.jpg", "c.jpg"])
+    raw = raw[:FIRST_MEMBER_END] + b"tar: ./Android/data: Permission denied\n" + raw[FIRST_MEMBER_END:]
+    with pytest.raises(tarfile.ReadError):
+        copy_tar(raw)
+
+
+@pytest.fixture
+def fake_adb(tmp_path, monkeypatch):
+    """Makes adb stream the bytes of tmp_path/device.tar and exit 0."""
+    monkeypatch.chdir(tmp_path)
+    stream = tmp_path / "device.tar"
+    real_popen = subprocess.Popen
+
+    def popen(cmd, **kwargs):
+        script = "import shutil, sys; shutil.copyfileobj(open(sys.argv[1], 'rb'), sys.stdout.buffer)"
+        return real_popen([sys.executable, "-c", script, str(stream)], **kwargs)
+
+    monkeypatch.setattr(backup.subprocess, "Popen", popen)
+    monkeypatch.setattr(backup.BackupManager, "_has_shell_v2", lambda self: True)
+    return stream
+
+
+def test_backup_device(tmp_path, fake_adb):
+    fake_adb.write_bytes(make_tar(["a.jpg", "b.jpg", "c.jpg"]))
+    bm = backup.BackupManager("test")
+    path = bm.backup_device("/sdcard/DCIM", "backups")
+    assert path
+    assert zipfile.ZipFile(bm.decrypt_backup(path)).namelist() == ["a.jpg", "b.jpg", "c.jpg"]
+
+
+def test_backup_device_discards_truncated_stream(tmp_path, fake_adb):
+    # The stream stops after the first file, yet adb exits 0
+    fake_adb.write_bytes(make_tar(["a.jpg", "b.jpg", "c.jpg"])[:FIRST_MEMBER_END])
+    assert backup.BackupManager("test").backup_device("/sdcard/DCIM", "backups") is None
+    assert os.listdir(tmp_path / "backups") == []
+
+
+def test_content_regexes():
+    contacts = "Row: 0 display_name=Smith, John, data1=+1 555 0100\r\nRow: 1 display_name=Ann, data1=NULL\n"
+    assert [m.groupdict() for m in backup.CONTACT_RE.finditer(contacts)] == [
+        {"name": "Smith, John", "phone": "+1 555 0100"},
+        {"name": "Ann", "phone": "NULL"},
+    ]
+    sms = "Row: 0 address=+15550100, date=1700000000000, type=1, body=Hi, it's me, date=soon  \n"
+    assert [m.groupdict() for m in backup.SMS_RE.finditer(sms)] == [
+        {"address": "+15550100", "date": "1700000000000", "type": "1", "body": "Hi, it's me, date=soon"}
+    ]
+    calls = "Row: 0 number=100, date=1700000000000, duration=42, type=2, name=Doe, Jane\n"
+    assert [m.groupdict() for m in backup.CALL_RE.finditer(calls)] == [
+        {"number": "100", "date": "1700000000000", "duration": "42", "type": "2", "name": "Doe, Jane"}
+    ]
+
+
+def test_content_regexes_skip_continuation_lines():
+    # A multi-line body leaves its later lines unmatched rather than misparsed
+    sms = "Row: 0 address=1, date=2, type=1, body=first\nsecond, type=2\nRow: 1 address=3, date=4, type=2, body=x\n"
+    assert [m["address"] for m in backup.SMS_RE.finditer(sms)] == ["1", "3"]
+
+
+BODIES = [
+    "",
+    "plain",
+    "it's \"quoted\"",
+    "$(reboot) `id` $HOME; exit 1",
+    "line one\nline two\n",
+    "\n",
+    "'\n'",
+    "emoji \U0001f600 and a\ttab",
+]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="needs a POSIX sh")
+@pytest.mark.parametrize("body", BODIES)
+def test_sms_insert_line_round_trips_through_sh(body):
+    bm = backup.BackupManager("test")
+    line = bm._sms_insert_line({"address": "+1 555", "body": body, "date": 5, "type": 2})
+    assert backup.SMS_SCRIPT_LINE_RE.fullmatch(line)
+    # Stand-in for the device's content tool: prints each argument it gets
+    script = backup.SMS_SCRIPT_HEADER + "content() { for a; do printf '%s\\0' \"$a\"; done; }\n" + line
+    result = subprocess.run(["sh", "-c", script], capture_output=True, check=True)
+    args = result.stdout.decode().split("\0")[:-1]
+    assert args == [
+        "insert", "--uri", "content://sms",
+        "--bind", "address:s:+1 555",
+        "--bind", f"body:s:{body}",
+        "--bind", "date:l:5",
+        "--bind", "type:i:2",
+    ]
+
+
+def write_sms_backup(tmp_path, messages, script_lines=None):
+    path = tmp_path / "sms_backup.ndjson"
+    path.write_bytes(b"".join(backup._json_line(m) for m in messages))
+    if script_lines is not None:
+        with open(backup._sms_script_path(str(path)), "w", encoding="utf-8", newline="\n") as script:
+            script.writelines(script_lines)
+    return str(path)
+
+
+MESSAGES = [{"address": "1", "body": "a", "date": 1, "type": 1}, {"address": "2", "body": "b\nc", "date": 2, "type": 2}]
+
+
+def test_sms_script_used_when_valid(tmp_path):
+    bm = backup.BackupManager("test")
+    lines = [bm._sms_insert_line({**m, "body": "from script"}) for m in MESSAGES]
+    path = write_sms_backup(tmp_path, MESSAGES, [backup.SMS_SCRIPT_MAGIC, *lines])
+    assert list(bm._iter_sms_insert_lines(path)) == lines
+
+
+@pytest.mark.parametrize("tamper", ["extra_line", "no_magic", "stale"])
+def test_sms_script_rejected(tmp_path, tamper):
+    bm = backup.BackupManager("test")
+    lines = [backup.SMS_SCRIPT_MAGIC] + [bm._sms_insert_line({**m, "body": "from script"}) for m in MESSAGES]
+    if tamper == "extra_line":
+        lines.insert(2, lines[1].rstrip("\n") + "; reboot\n")
+    elif tamper == "no_magic":
+        lines.pop(0)
+    path = write_sms_backup(tmp_path, MESSAGES, lines)
+    if tamper == "stale":
+        os.utime(backup._sms_script_path(path), (0, 0))
+    assert bm._sms_script_problem(backup._sms_script_path(path), path)
+    assert list(bm._iter_sms_insert_lines(path)) == [bm._sms_insert_line(m) for m in MESSAGES]
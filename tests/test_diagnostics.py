@@ -0,0 +1,57 @@
+from diagnostics import BATCH_SEPARATOR, BATCH_STATUS_RE, Diagnostics
+
+BATTERY = """Current Battery Service state:
+  AC powered: false
+  USB powered: true
+  status: 2
+  health: 2
+  level: 87
+  scale: 100
+"""
+
+DF = """Filesystem        1K-blocks    Used Available Use% Mounted on
+/dev/block/dm-5   115249236 4200000 111049236   4% /data
+"""
+
+
+def test_parse_battery():
+    assert Diagnostics("test")._parse_battery(BATTERY) == {"level": "87", "status": "Charging"}
+
+
+def test_parse_battery_unknown_status():
+    assert Diagnostics("test")._parse_battery("  status: 9\n") == {"status": "9"}
+
+
+def test_parse_battery_empty():
+    assert Diagnostics("test")._parse_battery(None) == {}
+
+
+def test_parse_storage():
+    assert Diagnostics("test")._parse_storage(DF) == {
+        "total": "115249236", "used": "4200000", "available": "111049236", "percent": "4%"
+    }
+
+
+def test_batch_status_re():
+    text = f"one\n\n{BATCH_SEPARATOR} 0\ntwo\n{BATCH_SEPARATOR} 1\r\n"
+    assert BATCH_STATUS_RE.split(text) == ["one\n", "0", "two", "1", ""]
+
+
+def test_batch_judges_each_command(adb_sh):
+    outputs = Diagnostics("test")._run_shell_batch([
+        ["echo", "first"],
+        ["sh", "-c", "echo broken; exit 3"],
+        ["printf", "no newline"],
+        ["sh", "-c", "exit 1"],
+    ])
+    assert outputs == ["first", None, "no newline", None]
+
+
+def test_batch_cut_short(adb_sh):
+    # The second command takes the whole device shell down with it
+    outputs = Diagnostics("test")._run_shell_batch([
+        ["echo", "first"],
+        ["sh", "-c", "kill -9 $PPID"],
+        ["echo", "never"],
+    ])
+    assert outputs == ["first", None, None]
@@ -0,0 +1,63 @@
+import pytest
+
+from shell import MARKER_PREFIX, AdbShell
+
+
+@pytest.fixture
+def session(adb_sh):
+    shell = AdbShell("test")
+    yield shell
+    shell.close()
+
+
+def test_output_and_exit_code(session):
+    assert session.run("echo", "hello world") == (0, "hello world")
+    assert session.run("sh", "-c", "echo out; echo err >&2; exit 3") == (3, "out\nerr")
+
+
+def test_output_without_trailing_newline(session):
+    assert session.run("printf", "abc") == (0, "abc")
+    assert session.run("printf", "") == (0, "")
+    assert session.run("printf", "a\n\n") == (0, "a\n")
+
+
+def test_arguments_are_quoted(session):
+    assert session.run("echo", "it's $HOME; `id`") == (0, "it's $HOME; `id`")
+
+
+def test_output_mentioning_the_marker(session):
+    assert session.run("echo", MARKER_PREFIX) == (0, MARKER_PREFIX)
+
+
+def test_session_is_reused(session):
+    session.run("true")
+    proc = session._proc
+    session.run("true")
+    assert session._proc is proc
+
+
+def test_echoing_session(adb_sh, monkeypatch):
+    # sh -v prints every line it reads, like a pty-backed adb shell
+    monkeypatch.setenv("FAKE_ADB_SH_FLAGS", "-v")
+    shell = AdbShell("test")
+    try:
+        assert shell.run("echo", "hi") == (0, "hi")
+        assert shell.run("sh", "-c", "exit 2") == (2, "")
+    finally:
+        shell.close()
+
+
+def test_session_ending_raises_oserror(session):
+    with pytest.raises(OSError):
+        session.run("exit", "0")
+    # The next command starts a new session
+    assert session.run("echo", "back") == (0, "back")
+
+
+def test_close(session):
+    session.run("true")
+    proc = session._proc
+    session.close()
+    assert session._proc is None
+    assert proc.poll() is not None
+    assert proc.stdout.closed